@@ -4,16 +4,17 @@ Laboratory work.
 Working with Large Language Models.
 """
 # pylint: disable=too-few-public-methods, undefined-variable, too-many-arguments, super-init-not-called
+from functools import lru_cache, partial
+from itertools import chain
 from pathlib import Path
-from typing import Iterable, Sequence
+from typing import Iterable
 
 import numpy as np
 import pandas as pd
 import torch
 from datasets import load_dataset
-from evaluate import load
-from torch.utils.data import DataLoader, Dataset
-from torchinfo import summary
+from evaluate import EvaluationModule, load
+from torch.utils.data import BatchSampler, DataLoader, Dataset
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
 from core_utils.llm.llm_pipeline import AbstractLLMPipeline
@@ -45,6 +46,21 @@ class RawDataImporter(AbstractRawDataImporter):
             raise TypeError("Downloaded dataset's type is not pd.DataFrame")
 
 
+def _to_binary_labels(labels: pd.Series) -> np.ndarray:
+    """
+    Convert labels to 1 for values that are exactly True and to 0 otherwise.
+
+    Args:
+        labels (pandas.Series): Original labels
+
+    Returns:
+        numpy.ndarray: Binary labels
+    """
+    if labels.dtype == bool:
+        return labels.to_numpy().astype(np.int8)
+    return np.fromiter((label is True for label in labels), dtype=np.int8, count=len(labels))
+
+
 class RawDataPreprocessor(AbstractRawDataPreprocessor):
     """
     A class that analyzes and preprocesses a dataset.
@@ -57,13 +73,15 @@ class RawDataPreprocessor(AbstractRawDataPreprocessor):
         Returns:
             dict: Dataset key properties
         """
-        lens = self._raw_data['neutral'].map(len, na_action='ignore')
-        data_no_na = self._raw_data.replace('', np.nan).dropna()
+        lens = self._raw_data['neutral'].str.len()
+        empty_rows = self._raw_data.isna().any(axis=1) | self._raw_data.eq('').any(axis=1)
+        row_hashes = pd.util.hash_pandas_object(self._raw_data, index=False).to_numpy()
+        _, row_counts = np.unique(row_hashes, return_counts=True)
         analysis = {
             'dataset_number_of_samples': len(self._raw_data),
             'dataset_columns': len(self._raw_data.columns),
-            'dataset_duplicates': self._raw_data.duplicated().sum(),
-            'dataset_empty_rows': len(self._raw_data) - len(data_no_na),
+            'dataset_duplicates': int((row_counts - 1).sum()),
+            'dataset_empty_rows': int(empty_rows.sum()),
             'dataset_sample_min_len': lens.min(),
             'dataset_sample_max_len': lens.max()
         }
@@ -74,13 +92,12 @@ class RawDataPreprocessor(AbstractRawDataPreprocessor):
         """
         Apply preprocessing transformations to the raw dataset.
         """
-        self._data = self._raw_data.copy()
-        self._data.rename(columns={'neutral': ColumnNames.SOURCE, 'toxic': ColumnNames.TARGET},
-                          inplace=True)
-        self._data.drop_duplicates(inplace=True)
-        self._data[ColumnNames.TARGET] = self._data[ColumnNames.TARGET].map(
-            lambda x: 1 if x is True else 0)
-        self._data.reset_index(inplace=True)
+        self._data = (
+            self._raw_data.drop_duplicates()
+            .assign(toxic=lambda frame: _to_binary_labels(frame['toxic']))
+            .rename(columns={'neutral': ColumnNames.SOURCE, 'toxic': ColumnNames.TARGET})
+            .reset_index()
+        )
 
 
 class TaskDataset(Dataset):
@@ -96,6 +113,7 @@ class TaskDataset(Dataset):
             data (pandas.DataFrame): Original data
         """
         self._data = data
+        self._sources: np.ndarray | None = None
 
     def __len__(self) -> int:
         """
@@ -116,7 +134,9 @@ class TaskDataset(Dataset):
         Returns:
             tuple[str, ...]: The item to be received
         """
-        return (self._data[ColumnNames.SOURCE].iloc[index],)
+        if self._sources is None:
+            self._sources = self._data[ColumnNames.SOURCE].to_numpy()
+        return (str(self._sources[index]),)
 
     @property
     def data(self) -> pd.DataFrame:
@@ -129,13 +149,60 @@ class TaskDataset(Dataset):
         return self._data
 
 
+class TokenizedTaskDataset(Dataset):
+    """
+    A class that tokenizes pd.DataFrame once and serves the encoded samples.
+    """
+
+    def __init__(self, data: pd.DataFrame, tokenizer: AutoTokenizer) -> None:
+        """
+        Initialize an instance of TokenizedTaskDataset.
+
+        Args:
+            data (pandas.DataFrame): Original data
+            tokenizer (transformers.models.auto.tokenization_auto.AutoTokenizer): Tokenizer to
+                tokenize the dataset
+        """
+        self._encodings = tokenizer(data[ColumnNames.SOURCE].astype(str).tolist(),
+                                    truncation=True)
+
+    def __len__(self) -> int:
+        """
+        Return the number of items in the dataset.
+
+        Returns:
+            int: The number of items in the dataset
+        """
+        return len(self._encodings['input_ids'])
+
+    def __getitem__(self, index: int) -> dict[str, list[int]]:
+        """
+        Retrieve an item from the dataset by index.
+
+        Args:
+            index (int): Index of sample in dataset
+
+        Returns:
+            dict[str, list[int]]: An element from the dataset
+        """
+        return {key: values[index] for key, values in self._encodings.items()}
+
+
 class LLMPipeline(AbstractLLMPipeline):
     """
     A class that initializes a model, analyzes its properties and infers it.
     """
 
     def __init__(
-        self, model_name: str, dataset: TaskDataset, max_length: int, batch_size: int, device: str
+        self,
+        model_name: str,
+        dataset: TaskDataset,
+        max_length: int,
+        batch_size: int,
+        device: str,
+        quantize: bool = False,
+        use_ort: bool = False,
+        half_precision: bool = False,
     ) -> None:
         """
         Initialize an instance of LLMPipeline.
@@ -146,13 +213,57 @@ class LLMPipeline(AbstractLLMPipeline):
             max_length (int): The maximum length of generated sequence
             batch_size (int): The size of the batch inside DataLoader
             device (str): The device for inference
+            quantize (bool): Whether to apply INT8 dynamic quantization to linear layers on CPU
+            use_ort (bool): Whether to export the model to ONNX and infer it with ONNX Runtime
+            half_precision (bool): Whether to load weights in bfloat16 (or float16 where bfloat16
+                is not supported) on CUDA
+
+        Raises:
+            ImportError: In case of ONNX Runtime is requested but not installed
+            ValueError: In case of quantization is requested together with ONNX Runtime
         """
 
         super().__init__(model_name, dataset, max_length, batch_size, device)
 
-        self._model = AutoModelForSequenceClassification.from_pretrained(model_name)
-        self._model.eval()
-        self._model.to(self._device)
+        torch.set_float32_matmul_precision('high')
+        on_cuda = self._device.startswith('cuda')
+        dtype = torch.float32
+        if half_precision and on_cuda:
+            dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        self._use_ort = use_ort
+        if use_ort:
+            if quantize:
+                raise ValueError('Quantization is not supported with ONNX Runtime')
+            # optional backend, imported only when requested
+            try:
+                # pylint: disable-next=import-outside-toplevel
+                from onnxruntime import GraphOptimizationLevel, SessionOptions
+
+                # pylint: disable-next=import-outside-toplevel
+                from optimum.onnxruntime import ORTModelForSequenceClassification
+            except ImportError as error:
+                raise ImportError('Libraries "onnxruntime" and "optimum" are required to infer '
+                                  'with ONNX Runtime') from error
+            session_options = SessionOptions()
+            session_options.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_ALL
+            self._model = ORTModelForSequenceClassification.from_pretrained(
+                model_name,
+                export=True,
+                provider='CUDAExecutionProvider' if on_cuda else 'CPUExecutionProvider',
+                session_options=session_options)
+        else:
+            try:
+                self._model = AutoModelForSequenceClassification.from_pretrained(
+                    model_name, torch_dtype=dtype, attn_implementation='sdpa')
+            except ValueError:
+                self._model = AutoModelForSequenceClassification.from_pretrained(
+                    model_name, torch_dtype=dtype)
+            self._model.eval()
+            if quantize and not on_cuda:
+                self._model = torch.ao.quantization.quantize_dynamic(self._model,
+                                                                     {torch.nn.Linear},
+                                                                     dtype=torch.qint8)
+            self._model.to(self._device)
         self._tokenizer = AutoTokenizer.from_pretrained(model_name)
 
     def analyze_model(self) -> dict:
@@ -164,29 +275,63 @@ class LLMPipeline(AbstractLLMPipeline):
         """
         config = self._model.config
         embeddings_length = config.max_position_embeddings
-        input_ids = torch.ones((1, embeddings_length), dtype=torch.long)
-        input_data = {
-            'input_ids': input_ids,
-            'attention_mask': input_ids
-        }
+        input_shape = [1, embeddings_length]
 
-        if not isinstance(self._model, torch.nn.Module):
+        if not self._use_ort and not isinstance(self._model, torch.nn.Module):
             raise ValueError('Model must have type torch.nn.Module')
 
-        model_summary = summary(self._model,
-                                input_data=input_data,
-                                verbose=0)
+        probe_ids = torch.ones((1, 8), dtype=torch.long, device=self._device)
+        probe = {'input_ids': probe_ids, 'attention_mask': probe_ids}
+        if self._use_ort and 'token_type_ids' in self._model.input_names:
+            probe['token_type_ids'] = torch.zeros_like(probe_ids)
+        with torch.inference_mode():
+            output = self._model(**probe).logits
+        num_trainable_params, size = self._ort_weights() if self._use_ort else self._torch_weights()
         analysis = {
-            'input_shape': {k: list(v.shape) for k, v in input_data.items()},
+            'input_shape': {'input_ids': input_shape, 'attention_mask': input_shape},
             'embedding_size': embeddings_length,
-            'output_shape': model_summary.summary_list[-1].output_size,
-            'num_trainable_params': model_summary.trainable_params,
+            'output_shape': list(output.shape),
+            'num_trainable_params': num_trainable_params,
             'vocab_size': config.vocab_size,
-            'size': model_summary.total_param_bytes,
+            'size': size,
             'max_context_length': self._model.config.max_length
         }
         return analysis
 
+    def _torch_weights(self) -> tuple[int, int]:
+        """
+        Count trainable parameters and weight bytes of a PyTorch model.
+
+        Returns:
+            tuple[int, int]: The number of trainable parameters and the size of weights in bytes
+        """
+        # frozen packed weights of dynamically quantized layers only count towards size
+        quantized_weights = [
+            weight
+            for module in self._model.modules()
+            if isinstance(module, torch.ao.nn.quantized.dynamic.Linear)
+            for weight in (module.weight(), module.bias())
+            if weight is not None
+        ]
+        trainable_params = [param for param in self._model.parameters() if param.requires_grad]
+        weights = [*self._model.parameters(), *quantized_weights]
+        return (sum(param.numel() for param in trainable_params),
+                sum(weight.numel() * weight.element_size() for weight in weights))
+
+    def _ort_weights(self) -> tuple[int, int]:
+        """
+        Count trainable parameters and weight bytes of an exported ONNX Runtime model.
+
+        Returns:
+            tuple[int, int]: The number of trainable parameters and the size of weights in bytes
+        """
+        # onnx is installed together with optimum's ONNX Runtime backend
+        from onnx import load, numpy_helper  # pylint: disable=import-outside-toplevel
+
+        initializers = load(self._model.model_path).graph.initializer
+        # graph initializers are frozen, so an exported model has no trainable parameters
+        return 0, sum(numpy_helper.to_array(tensor).nbytes for tensor in initializers)
+
     @report_time
     def infer_sample(self, sample: tuple[str, ...]) -> str | None:
         """
@@ -199,7 +344,11 @@ class LLMPipeline(AbstractLLMPipeline):
             str | None: A prediction
         """
         if self._model:
-            return self._infer_batch([sample])[0]
+            tokens = self._tokenizer(sample,
+                                     return_tensors='pt',
+                                     padding=True,
+                                     truncation=True)
+            return self._infer_batch(tokens)[0]
         return None
 
     @report_time
@@ -210,35 +359,58 @@ class LLMPipeline(AbstractLLMPipeline):
         Returns:
             pd.DataFrame: Data with predictions
         """
-        dataloader = DataLoader(self._dataset, self._batch_size)
-        preds = sum([self._infer_batch(batch) for batch in dataloader], [])
-        return pd.DataFrame({ColumnNames.TARGET.value: self._dataset.data[ColumnNames.TARGET],
-                             ColumnNames.PREDICTION.value: preds})
-
-
-    @torch.no_grad()
-    def _infer_batch(self, sample_batch: Sequence[tuple[str, ...]]) -> list[str]:
+        if len(self._dataset) == 0:
+            return pd.DataFrame(columns=[ColumnNames.TARGET.value, ColumnNames.PREDICTION.value])
+        dataset = TokenizedTaskDataset(self._dataset.data, self._tokenizer)
+        lengths = self._dataset.data[ColumnNames.SOURCE].astype(str).str.len().to_numpy()
+        order = np.argsort(-lengths, kind='stable')
+        dataloader = DataLoader(dataset,
+                                batch_sampler=BatchSampler(order.tolist(), self._batch_size,
+                                                           drop_last=False),
+                                collate_fn=partial(self._tokenizer.pad, return_tensors='pt'),
+                                pin_memory=self._device.startswith('cuda'))
+        sorted_preds = list(chain.from_iterable(self._infer_batch(batch) for batch in dataloader))
+        preds = np.empty(len(order), dtype=object)
+        preds[order] = np.asarray(sorted_preds, dtype=object)
+        targets = self._dataset.data[ColumnNames.TARGET].to_numpy()
+        return pd.DataFrame({ColumnNames.TARGET.value: targets,
+                             ColumnNames.PREDICTION.value: preds},
+                            copy=False)
+
+    @torch.inference_mode()
+    def _infer_batch(self, tokens: dict[str, torch.Tensor]) -> list[str]:
         """
         Infer model on a single batch.
 
         Args:
-            sample_batch (Sequence[tuple[str, ...]]): Batch to infer the model
+            tokens (dict[str, torch.Tensor]): Tokenized batch padded to its longest sample
 
         Returns:
             list[str]: Model predictions as strings
         """
         if not self._model:
             raise ValueError('Model is not defined')
-        tokens = self._tokenizer(list(sample_batch[0]),
-                                 return_tensors='pt',
-                                 padding=True,
-                                 truncation=True)
+        tokens = {key: value.to(self._device, non_blocking=True) for key, value in tokens.items()}
         output = self._model(**tokens).logits
-        logits = torch.argmax(output, dim=1)
-        return [str(logit.item()) for logit in logits]
+        return list(map(str, torch.argmax(output, dim=1).tolist()))
 
 
 
+@lru_cache(maxsize=None)
+def _load_metric(name: str, seed: int | None = None) -> EvaluationModule:
+    """
+    Load an evaluation metric once and reuse it for subsequent calls.
+
+    Args:
+        name (str): Name of the metric
+        seed (int | None): Seed for metrics that rely on randomness
+
+    Returns:
+        evaluate.EvaluationModule: Loaded metric
+    """
+    return load(name, seed=seed)
+
+
 class TaskEvaluator(AbstractTaskEvaluator):
     """
     A class that compares prediction quality using the specified metric.
@@ -264,10 +436,12 @@ class TaskEvaluator(AbstractTaskEvaluator):
             dict | None: A dictionary containing information about the calculated metric
         """
         target2pred = pd.read_csv(self.data_path)
+        targets = target2pred[ColumnNames.TARGET.value].to_numpy()
+        predictions = target2pred[ColumnNames.PREDICTION.value].to_numpy()
         results = {}
         for metric in self.metrics:
-            result = load(str(metric)).compute(predictions=target2pred[ColumnNames.TARGET.value],
-                                          references=target2pred[ColumnNames.PREDICTION.value],
-                                          average='micro')
+            result = _load_metric(str(metric)).compute(predictions=predictions,
+                                                       references=targets,
+                                                       average='micro')
             results.update(result)
         return results
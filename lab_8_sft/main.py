@@ -4,16 +4,19 @@ Laboratory work.
 Fine-tuning Large Language Models for a downstream task.
 """
 # pylint: disable=too-few-public-methods, undefined-variable, duplicate-code, unused-argument, too-many-arguments
+import queue
+import threading
+import weakref
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Iterable, Sequence
-from unittest.mock import inplace
+from typing import Any, Iterable
 
 import numpy as np
 import pandas as pd
 import torch
 from datasets import load_dataset
-from evaluate import load
-from torch.utils.data import DataLoader, Dataset
+from evaluate import EvaluationModule, load
+from torch.utils.data import BatchSampler, DataLoader, Dataset
 from torchinfo import summary
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 
@@ -56,13 +59,15 @@ class RawDataPreprocessor(AbstractRawDataPreprocessor):
         Returns:
             dict: dataset key properties.
         """
-        lens = self._raw_data['article_content'].map(len, na_action='ignore')
-        data_no_na = self._raw_data.replace('', np.nan).dropna()
+        lens = self._raw_data['article_content'].str.len()
+        empty_rows = self._raw_data.isna().any(axis=1) | self._raw_data.eq('').any(axis=1)
+        row_hashes = pd.util.hash_pandas_object(self._raw_data, index=False).to_numpy()
+        _, row_counts = np.unique(row_hashes, return_counts=True)
         analysis = {
             'dataset_number_of_samples': len(self._raw_data),
             'dataset_columns': len(self._raw_data.columns),
-            'dataset_duplicates': self._raw_data.duplicated().sum(),
-            'dataset_empty_rows': len(self._raw_data) - len(data_no_na),
+            'dataset_duplicates': int((row_counts - 1).sum()),
+            'dataset_empty_rows': int(empty_rows.sum()),
             'dataset_sample_min_len': lens.min(),
             'dataset_sample_max_len': lens.max()
         }
@@ -73,11 +78,11 @@ class RawDataPreprocessor(AbstractRawDataPreprocessor):
         """
         Apply preprocessing transformations to the raw dataset.
         """
-        self._data = self._raw_data.copy()
-        self._data.drop(['title', 'date', 'url'], axis=1, inplace=True)
-        self._data.rename(columns={'article_content': ColumnNames.SOURCE, 'summary': ColumnNames.TARGET},
-                          inplace=True)
-        self._data.reset_index(inplace=True)
+        self._data = (
+            self._raw_data.drop(columns=['title', 'date', 'url'])
+            .rename(columns={'article_content': ColumnNames.SOURCE, 'summary': ColumnNames.TARGET})
+            .reset_index()
+        )
 
 
 class TaskDataset(Dataset):
@@ -93,6 +98,7 @@ class TaskDataset(Dataset):
             data (pandas.DataFrame): Original data
         """
         self._data = data
+        self._sources: np.ndarray | None = None
 
     def __len__(self) -> int:
         """
@@ -113,7 +119,9 @@ class TaskDataset(Dataset):
         Returns:
             tuple[str, ...]: The item to be received
         """
-        return (str(self._data[ColumnNames.SOURCE].iloc[index]),)
+        if self._sources is None:
+            self._sources = self._data[ColumnNames.SOURCE].to_numpy()
+        return (str(self._sources[index]),)
 
     @property
     def data(self) -> pd.DataFrame:
@@ -157,6 +165,13 @@ class TokenizedTaskDataset(Dataset):
                 tokenize the dataset
             max_length (int): max length of a sequence
         """
+        self._data = data
+        encodings = tokenizer(data[ColumnNames.SOURCE].astype(str).tolist(),
+                              padding=False,
+                              truncation=True,
+                              max_length=max_length)
+        self._input_ids: list[list[int]] = encodings['input_ids']
+        self._attention_mask: list[list[int]] = encodings['attention_mask']
 
     def __len__(self) -> int:
         """
@@ -165,8 +180,9 @@ class TokenizedTaskDataset(Dataset):
         Returns:
             int: The number of items in the dataset
         """
+        return len(self._input_ids)
 
-    def __getitem__(self, index: int) -> dict[str, torch.Tensor]:
+    def __getitem__(self, index: int) -> dict[str, list[int]]:
         """
         Retrieve an item from the dataset by index.
 
@@ -174,8 +190,66 @@ class TokenizedTaskDataset(Dataset):
             index (int): Index of sample in dataset
 
         Returns:
-            dict[str, torch.Tensor]: An element from the dataset
+            dict[str, list[int]]: An element from the dataset
         """
+        return {
+            'input_ids': self._input_ids[index],
+            'attention_mask': self._attention_mask[index]
+        }
+
+
+def _tokenize_worker(
+    requests: queue.Queue, tokenizer: AutoTokenizer, max_length: int, max_batch_size: int = 32
+) -> None:
+    """
+    Tokenize queued samples in batches until a stop sentinel is received.
+
+    Args:
+        requests (queue.Queue): Queue of tokenization requests, None stops the worker
+        tokenizer (transformers.models.auto.tokenization_auto.AutoTokenizer): Tokenizer to
+            tokenize the samples
+        max_length (int): max length of a sequence
+        max_batch_size (int): The maximum number of samples tokenized in one call
+    """
+    while True:
+        batch = [requests.get()]
+        # only samples that are already waiting join the batch, a lone request is not delayed
+        while len(batch) < max_batch_size:
+            try:
+                batch.append(requests.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in batch
+        batch = [request for request in batch if request is not None]
+        encodings = None
+        try:
+            if batch:
+                encodings = tokenizer([text for request in batch for text in request['texts']],
+                                      max_length=max_length,
+                                      truncation=True)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # one bad sample must not fail the whole batch, retry every request on its own
+            encodings = None
+        start = 0
+        for request in batch:
+            end = start + len(request['texts'])
+            try:
+                if encodings is None:
+                    request['tokens'] = tokenizer(request['texts'],
+                                                  max_length=max_length,
+                                                  return_tensors='pt',
+                                                  padding=True,
+                                                  truncation=True)
+                else:
+                    request['tokens'] = tokenizer.pad(
+                        {key: values[start:end] for key, values in encodings.items()},
+                        return_tensors='pt')
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                request['error'] = error
+            start = end
+            request['done'].set()
+        if stop:
+            return
 
 
 class LLMPipeline(AbstractLLMPipeline):
@@ -184,7 +258,14 @@ class LLMPipeline(AbstractLLMPipeline):
     """
 
     def __init__(
-        self, model_name: str, dataset: TaskDataset, max_length: int, batch_size: int, device: str
+        self,
+        model_name: str,
+        dataset: TaskDataset,
+        max_length: int,
+        batch_size: int,
+        device: str,
+        batch_tokenization: bool = False,
+        half_precision: bool = False,
     ) -> None:
         """
         Initialize an instance of LLMPipeline.
@@ -195,13 +276,30 @@ class LLMPipeline(AbstractLLMPipeline):
             max_length (int): The maximum length of generated sequence.
             batch_size (int): The size of the batch inside DataLoader.
             device (str): The device for inference.
+            batch_tokenization (bool): Whether concurrent infer_sample calls share tokenizer
+                calls on a background thread.
+            half_precision (bool): Whether to load weights in bfloat16 (or float16 where bfloat16
+                is not supported) on CUDA.
         """
         super().__init__(model_name, dataset, max_length, batch_size, device)
 
-        self._model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+        torch.set_float32_matmul_precision('high')
+        dtype = torch.float32
+        if half_precision and self._device.startswith('cuda'):
+            dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        try:
+            self._model = AutoModelForSeq2SeqLM.from_pretrained(
+                model_name, torch_dtype=dtype, attn_implementation='sdpa')
+        except ValueError:
+            self._model = AutoModelForSeq2SeqLM.from_pretrained(model_name, torch_dtype=dtype)
         self._model.eval()
         self._model.to(self._device)
         self._tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self._tokenize_queue: queue.Queue[dict[str, Any] | None] | None = (
+            queue.Queue() if batch_tokenization else None
+        )
+        self._tokenize_thread: threading.Thread | None = None
+        self._tokenize_lock = threading.Lock()
 
     def analyze_model(self) -> dict:
         """
@@ -212,22 +310,21 @@ class LLMPipeline(AbstractLLMPipeline):
         """
         config = self._model.config
         embeddings_length = config.d_model
-        input_ids = torch.ones((1, embeddings_length), dtype=torch.long)
-        input_data = {
-            'input_ids': input_ids,
-            'decoder_input_ids': input_ids
-        }
+        input_shape = [1, embeddings_length]
 
         if not isinstance(self._model, torch.nn.Module):
             raise ValueError('Model must have type torch.nn.Module')
 
+        # parameter accounting does not depend on sequence length, so a short probe is enough
+        probe_ids = torch.ones((1, 8), dtype=torch.long)
         model_summary = summary(self._model,
-                                input_data=input_data,
+                                input_data={'input_ids': probe_ids,
+                                            'decoder_input_ids': probe_ids},
                                 verbose=0)
         analysis = {
-            'input_shape': list(input_data['input_ids'].shape),
+            'input_shape': input_shape,
             'embedding_size': embeddings_length,
-            'output_shape': model_summary.summary_list[-1].output_size,
+            'output_shape': [*input_shape, model_summary.summary_list[-1].output_size[-1]],
             'num_trainable_params': model_summary.trainable_params,
             'vocab_size': config.vocab_size,
             'size': model_summary.total_param_bytes,
@@ -247,7 +344,15 @@ class LLMPipeline(AbstractLLMPipeline):
             str | None: A prediction
         """
         if self._model:
-            return self._infer_batch([sample])[0]
+            if self._tokenize_queue is None:
+                tokens = self._tokenizer(sample,
+                                         max_length=self._max_length,
+                                         return_tensors='pt',
+                                         padding=True,
+                                         truncation=True)
+            else:
+                tokens = self._tokenize_queued(sample)
+            return self._infer_batch(tokens)[0]
         return None
 
     @report_time
@@ -258,35 +363,89 @@ class LLMPipeline(AbstractLLMPipeline):
         Returns:
             pd.DataFrame: Data with predictions
         """
-        dataloader = DataLoader(self._dataset, self._batch_size)
-        preds = []
+        if len(self._dataset) == 0:
+            return pd.DataFrame(columns=[ColumnNames.TARGET.value, ColumnNames.PREDICTION.value])
+        dataset = TokenizedTaskDataset(self._dataset.data, self._tokenizer, self._max_length)
+        lengths = self._dataset.data[ColumnNames.SOURCE].astype(str).str.len().to_numpy()
+        order = np.argsort(-lengths, kind='stable')
+        dataloader = DataLoader(dataset,
+                                batch_sampler=BatchSampler(order.tolist(), self._batch_size,
+                                                           drop_last=False),
+                                collate_fn=partial(self._tokenizer.pad, return_tensors='pt'),
+                                pin_memory=self._device.startswith('cuda'))
+        sorted_preds = []
         for batch in dataloader:
             pred = self._infer_batch(batch)
-            preds.extend(pred)
-        return pd.DataFrame({ColumnNames.TARGET.value: self._dataset.data[ColumnNames.TARGET],
-                             ColumnNames.PREDICTION.value: preds})
+            sorted_preds.extend(pred)
+        preds = np.empty(len(order), dtype=object)
+        preds[order] = np.asarray(sorted_preds, dtype=object)
+        targets = self._dataset.data[ColumnNames.TARGET].to_numpy()
+        return pd.DataFrame({ColumnNames.TARGET.value: targets,
+                             ColumnNames.PREDICTION.value: preds},
+                            copy=False)
 
-    @torch.no_grad()
-    def _infer_batch(self, sample_batch: Sequence[tuple[str, ...]]) -> list[str]:
+    def _tokenize_queued(self, sample: tuple[str, ...]) -> dict[str, torch.Tensor]:
+        """
+        Tokenize a sample through the shared background tokenization queue.
+
+        Args:
+            sample (tuple[str, ...]): The sample to tokenize
+
+        Returns:
+            dict[str, torch.Tensor]: Tokenized sample
+        """
+        with self._tokenize_lock:
+            if self._tokenize_thread is None:
+                self._tokenize_thread = threading.Thread(
+                    target=_tokenize_worker,
+                    args=(self._tokenize_queue, self._tokenizer, self._max_length),
+                    daemon=True,
+                )
+                self._tokenize_thread.start()
+                # the worker holds no reference to the pipeline and stops once it is collected
+                weakref.finalize(self, self._tokenize_queue.put, None)
+        request = {'texts': list(sample), 'done': threading.Event()}
+        self._tokenize_queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['tokens']
+
+    @torch.inference_mode()
+    def _infer_batch(self, tokens: dict[str, torch.Tensor]) -> list[str]:
         """
         Infer single batch.
 
         Args:
-            sample_batch (Sequence[tuple[str, ...]]): batch to infer the model
+            tokens (dict[str, torch.Tensor]): tokenized batch padded to its longest sample
 
         Returns:
             list[str]: model predictions as strings
         """
         if not self._model:
             raise ValueError('Model is not defined')
-        tokens = self._tokenizer(list(sample_batch[0]),
-                                 max_length=self._max_length,
-                                 return_tensors='pt',
-                                 padding=True,
-                                 truncation=True).to(self._device)
-        output = self._model.generate(**tokens, max_length=self._max_length)
-        output_seqs = self._tokenizer.batch_decode(output, skip_special_tokens=True)
-        return [str(seq) for seq in output_seqs]
+        tokens = {key: value.to(self._device, non_blocking=True) for key, value in tokens.items()}
+        output = self._model.generate(**tokens,
+                                      max_length=self._max_length,
+                                      num_beams=1,
+                                      do_sample=False,
+                                      use_cache=True)
+        return self._tokenizer.batch_decode(output.cpu(), skip_special_tokens=True)
+
+
+@lru_cache(maxsize=None)
+def _load_metric(name: str, seed: int | None = None) -> EvaluationModule:
+    """
+    Load an evaluation metric once and reuse it for subsequent calls.
+
+    Args:
+        name (str): Name of the metric
+        seed (int | None): Seed for metrics that rely on randomness
+
+    Returns:
+        evaluate.EvaluationModule: Loaded metric
+    """
+    return load(name, seed=seed)
 
 
 class TaskEvaluator(AbstractTaskEvaluator):
@@ -313,12 +472,14 @@ class TaskEvaluator(AbstractTaskEvaluator):
             dict | None: A dictionary containing information about the calculated metric
         """
         target2pred = pd.read_csv(self.data_path)
+        targets = target2pred[ColumnNames.TARGET.value].to_numpy()
+        predictions = target2pred[ColumnNames.PREDICTION.value].to_numpy()
         results = {}
         for metric in self.metrics:
             metric = str(metric)
-            result = load(metric, seed=77).compute(
-                predictions=target2pred[ColumnNames.PREDICTION.value],
-                references=target2pred[ColumnNames.TARGET.value]
+            result = _load_metric(metric, seed=77).compute(
+                predictions=predictions,
+                references=targets
             )
             if metric == Metrics.ROUGE.value:
                 results[metric] = result['rougeL']
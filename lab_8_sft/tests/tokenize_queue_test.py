@@ -0,0 +1,136 @@
+"""
+Checks the background tokenization queue of the pipeline
+"""
+# pylint: disable=protected-access, unused-argument
+import gc
+import queue
+import threading
+import unittest
+
+import pytest
+
+from lab_8_sft.main import LLMPipeline, _tokenize_worker
+
+
+class FakeTokenizer:
+    """
+    Tokenizer stub that records its calls and fails on the 'bad' sample
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize an instance of FakeTokenizer
+        """
+        self.calls: list[list[str]] = []
+
+    def __call__(self, texts: list[str], **kwargs: object) -> dict[str, list[list[int]]]:
+        """
+        Tokenize texts into their lengths
+        """
+        self.calls.append(list(texts))
+        if 'bad' in texts:
+            raise ValueError('Cannot tokenize the sample')
+        return {'input_ids': [[len(text)] for text in texts]}
+
+    def pad(self, encodings: dict, **kwargs: object) -> dict:
+        """
+        Return the encodings as they are
+        """
+        return encodings
+
+
+def make_request(*texts: str) -> dict:
+    """
+    Create a tokenization request
+    """
+    return {'texts': list(texts), 'done': threading.Event()}
+
+
+class TokenizeQueueTest(unittest.TestCase):
+    """
+    Tests the batched tokenization worker
+    """
+
+    @pytest.mark.lab_8_sft
+    @pytest.mark.mark10
+    def test_waiting_requests_are_batched(self) -> None:
+        """
+        Requests waiting in the queue are tokenized in one call
+        """
+        tokenizer = FakeTokenizer()
+        requests: queue.Queue = queue.Queue()
+        batch = [make_request('a'), make_request('bb', 'ccc'), make_request('dddd')]
+        for request in batch:
+            requests.put(request)
+        requests.put(None)
+
+        _tokenize_worker(requests, tokenizer, max_length=8)
+
+        self.assertEqual([['a', 'bb', 'ccc', 'dddd']], tokenizer.calls)
+        self.assertEqual({'input_ids': [[1]]}, batch[0]['tokens'])
+        self.assertEqual({'input_ids': [[2], [3]]}, batch[1]['tokens'])
+        self.assertEqual({'input_ids': [[4]]}, batch[2]['tokens'])
+        self.assertTrue(all(request['done'].is_set() for request in batch))
+
+    @pytest.mark.lab_8_sft
+    @pytest.mark.mark10
+    def test_failing_request_is_isolated(self) -> None:
+        """
+        A failing sample only fails its own request
+        """
+        tokenizer = FakeTokenizer()
+        requests: queue.Queue = queue.Queue()
+        batch = [make_request('a'), make_request('bad'), make_request('cc')]
+        for request in batch:
+            requests.put(request)
+        requests.put(None)
+
+        _tokenize_worker(requests, tokenizer, max_length=8)
+
+        self.assertEqual({'input_ids': [[1]]}, batch[0]['tokens'])
+        self.assertIsInstance(batch[1]['error'], ValueError)
+        self.assertNotIn('tokens', batch[1])
+        self.assertEqual({'input_ids': [[2]]}, batch[2]['tokens'])
+        self.assertTrue(all(request['done'].is_set() for request in batch))
+
+    @pytest.mark.lab_8_sft
+    @pytest.mark.mark10
+    def test_worker_stops_on_sentinel(self) -> None:
+        """
+        The worker returns once it receives the stop sentinel
+        """
+        requests: queue.Queue = queue.Queue()
+        worker = threading.Thread(target=_tokenize_worker,
+                                  args=(requests, FakeTokenizer(), 8),
+                                  daemon=True)
+        worker.start()
+        requests.put(None)
+        worker.join(timeout=5)
+
+        self.assertFalse(worker.is_alive())
+
+    @pytest.mark.lab_8_sft
+    @pytest.mark.mark10
+    def test_pipeline_errors_and_finalizer(self) -> None:
+        """
+        Errors reach the caller and the worker stops with the pipeline
+        """
+        pipeline = LLMPipeline.__new__(LLMPipeline)
+        pipeline._tokenizer = FakeTokenizer()
+        pipeline._max_length = 8
+        pipeline._tokenize_queue = queue.Queue()
+        pipeline._tokenize_thread = None
+        pipeline._tokenize_lock = threading.Lock()
+
+        self.assertEqual({'input_ids': [[2], [3]]}, pipeline._tokenize_queued(('bb', 'ccc')))
+        with self.assertRaises(ValueError):
+            pipeline._tokenize_queued(('bad',))
+
+        worker = pipeline._tokenize_thread
+        if worker is None:
+            self.fail('Tokenization worker was not started')
+        del pipeline
+        gc.collect()
+        worker.join(timeout=5)
+
+        self.assertFalse(worker.is_alive())